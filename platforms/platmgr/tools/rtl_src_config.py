@@ -9,14 +9,24 @@
 #
 
 import argparse
+import functools
 import os
 import sys
 import subprocess
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+# Held by the first error to be reported. Included configuration files are
+# parsed in parallel and sibling parses may fail for the same reason.
+_error_lock = threading.Lock()
 
 
 def errorExit(msg):
-    sys.stderr.write("\nrtl_src_config error: " + msg + "\n")
+    if (_error_lock.acquire(False)):
+        sys.stderr.write("\nrtl_src_config error: " + msg + "\n")
     sys.exit(1)
 
 
@@ -75,140 +85,257 @@ sim_vhdl_tag_map = {
 }
 
 
-def validateTag(filename):
-    _basename, ext = os.path.splitext(filename)
-    ext = ext.lower()
+# Merged view of all tag maps, indexed by file extension. Each entry is
+# a tuple of tags, one per map in the order below, with None where the
+# extension isn't in the map.
+TAG_MAPS = (quartus_tag_map, sim_vlog_tag_map, sim_vhdl_tag_map,
+            qsys_tag_map, qsys_ipx_tag_map, json_tag_map, tcl_tag_map)
+(TAG_QUARTUS, TAG_SIM_VLOG, TAG_SIM_VHDL,
+ TAG_QSYS, TAG_IPX, TAG_JSON, TAG_TCL) = range(len(TAG_MAPS))
+
+EXT_INFO = dict((ext, tuple(m.get(ext) for m in TAG_MAPS))
+                for tag_map in TAG_MAPS for ext in tag_map)
+
+# The same information as a bit mask per extension, with bit (1 << TAG_*)
+# set when the extension is in the corresponding map. Output modes are
+# selected by the matching bit.
+BIT_QUARTUS = 1 << TAG_QUARTUS
+BIT_SIM_VLOG = 1 << TAG_SIM_VLOG
+BIT_SIM_VHDL = 1 << TAG_SIM_VHDL
+BIT_QSYS = 1 << TAG_QSYS
+BIT_IPX = 1 << TAG_IPX
+BIT_JSON = 1 << TAG_JSON
+BIT_TCL = 1 << TAG_TCL
+
+EXT_MASK = dict((ext, sum(1 << t for t, tag in enumerate(info)
+                          if tag is not None))
+                for ext, info in EXT_INFO.items())
+
+# Output mode (set in main() from the command line) to EXT_MASK bit.
+MODE_BITS = {
+    'qsf':      BIT_QUARTUS,
+    'sim_vlog': BIT_SIM_VLOG,
+    'sim_vhdl': BIT_SIM_VHDL,
+    'qsys':     BIT_QSYS,
+    'ipx':      BIT_IPX,
+    'json':     BIT_JSON,
+    'tcl':      BIT_TCL
+}
+
+
+#
+# Lower case file extension, including the dot. Configuration entries have
+# conventional suffixes, so this is a cheaper stand-in for os.path.splitext.
+#
+def _ext(path):
+    i = path.rfind('.')
+    return path[i:].lower() if i > path.rfind('/') else ''
+
 
-    if (ext not in quartus_tag_map and
-            ext not in qsys_tag_map and
-            ext not in tcl_tag_map and
-            ext not in qsys_ipx_tag_map and
-            ext not in json_tag_map and
-            ext not in sim_vlog_tag_map and
-            ext not in sim_vhdl_tag_map):
+def validateTag(filename, ext):
+    if (ext not in EXT_INFO):
         errorExit(
             "unrecognized file extension '{0}' ({1})".format(ext, filename))
 
 
-def lookupTag(filename, db):
-    _basename, ext = os.path.splitext(filename)
-    ext = ext.lower()
+# Configuration directives with special handling. Both are 8 characters.
+DIRECTIVE_PREFIXES = ("+define+", "+incdir+")
 
-    if (ext not in db):
-        return None
-    else:
-        return db[ext]
+
+#
+# Classify a single configuration directive. Returns a tuple
+# (kind, payload, ext), where kind is one of 'define', 'incdir', 'si_vlog',
+# 'si_vhdl', 'qi' or 'src'. Unrecognized "+" directives return None.
+#
+def classify(c):
+    if (c.startswith("+")):
+        if (not c.startswith(DIRECTIVE_PREFIXES)):
+            # Unrecognized directive
+            return None
+        if (c.startswith("+define+")):
+            return ('define', c[8:], None)
+        return ('incdir', c[8:], None)
+
+    kind = 'src'
+    path = c
+
+    # Parse cmd:value
+    cmd, sep, value = c.partition(':')
+    if (sep):
+        if ("SI" == cmd or "SI_VLOG" == cmd):
+            kind = 'si_vlog'
+            path = value
+        elif ("SI_VHDL" == cmd):
+            kind = 'si_vhdl'
+            path = value
+        elif ("QI" == cmd):
+            return ('qi', value, None)
+
+    # The extension is computed once here and carried with the entry
+    ext = _ext(path)
+    if (kind == 'src'):
+        validateTag(c, ext)
+    return (kind, path, ext)
 
 
 #
 # Given a list of directives, emit the configuration.
 #
 def emitCfg(opts, cfg):
-    # Filtering for specific file types?
-    file_type_filter = opts.qsys or opts.ipx or opts.json or opts.tcl
+    mode_bit = MODE_BITS[opts.mode]
+
+    # Loop-invariant mode tests
+    quartus = (mode_bit == BIT_QUARTUS)
+    sim_vlog = (mode_bit == BIT_SIM_VLOG)
+    sim_vhdl = (mode_bit == BIT_SIM_VHDL)
+    si_vlog_tcl = mode_bit & (BIT_SIM_VLOG | BIT_TCL)
+    si_vhdl_tcl = mode_bit & (BIT_SIM_VHDL | BIT_TCL)
+
+    # Output is collected and written once at the end
+    out = []
+
+    # Parse each directive once, partitioning them by the order in which
+    # they are emitted: defines, then include paths, then everything else.
+    defines = []
+    incdirs = []
+    sources = []
+    for c in cfg:
+        e = classify(c)
+        if (e is None):
+            continue
+        kind = e[0]
+        if (kind == 'define'):
+            defines.append(e[1])
+        elif (kind == 'incdir'):
+            incdirs.append(e[1])
+        else:
+            sources.append(e)
 
     rel_prefix = ''
-    if (not file_type_filter):
-        if (not opts.sim and not opts.abs):
-            # For Quartus, generate a Tcl variable for relative paths
-            print('set THIS_DIR [file dirname [info script]]\n')
-            rel_prefix = '${THIS_DIR}/'
-
-        # First emit all preprocessor configuration
-        for c in cfg:
-            if ("+define+" == c[:8]):
-                if (opts.sim_vlog):
-                    print(c)
-                elif (opts.sim_vhdl):
-                    None
-                else:
-                    print('set_global_assignment -name VERILOG_MACRO "' +
-                          c[8:] + '"')
-
-        # Emit all include directives
-        for c in cfg:
-            if ("+incdir+" == c[:8]):
-                if (opts.sim_vlog):
-                    print(c)
-                elif (opts.sim_vhdl):
-                    None
-                else:
-                    print('set_global_assignment -name SEARCH_PATH "{0}{1}"'
-                          .format(rel_prefix, c[8:]))
+    if (quartus and not opts.abs):
+        # For Quartus, generate a Tcl variable for relative paths
+        out.append('set THIS_DIR [file dirname [info script]]\n')
+        rel_prefix = '${THIS_DIR}/'
+
+    # Preprocessor and include directives are emitted only for Quartus and
+    # Verilog simulation. Other modes filter for specific file types.
+    if (sim_vlog):
+        for value in defines:
+            out.append("+define+" + value)
+        for value in incdirs:
+            out.append("+incdir+" + value)
+    elif (quartus):
+        for value in defines:
+            out.append('set_global_assignment -name VERILOG_MACRO "' +
+                       value + '"')
+        for value in incdirs:
+            out.append('set_global_assignment -name SEARCH_PATH "{0}{1}"'
+                       .format(rel_prefix, value))
 
     # Emit sources and Quartus/simulator includes
-    for c in cfg:
-        # Parse cmd:value
-        try:
-            cmd, value = c.split(':', 1)
-            has_cmd = True
-        except ValueError:
-            has_cmd = False
-
-        if ("+" == c[:1]):
-            # Directive handled already
-            None
-        elif (has_cmd and ("SI" == cmd or "SI_VLOG" == cmd)):
+    for kind, value, ext in sources:
+        if (kind == 'si_vlog'):
             # Simulator include
-            if (lookupTag(value, tcl_tag_map) and (opts.sim_vlog or
-                                                   opts.tcl)):
-                print(value)
-            elif (opts.sim_vlog):
-                print("-F " + value)
-        elif (has_cmd and ("SI_VHDL" == cmd)):
+            if (si_vlog_tcl and EXT_MASK.get(ext, 0) & BIT_TCL):
+                out.append(value)
+            elif (sim_vlog):
+                out.append("-F " + value)
+        elif (kind == 'si_vhdl'):
             # Simulator include
-            if (lookupTag(value, tcl_tag_map) and (opts.sim_vhdl or
-                                                   opts.tcl)):
-                print(value)
-            elif (opts.sim_vhdl):
-                print("-F " + value)
-        elif (has_cmd and ("QI" == cmd)):
+            if (si_vhdl_tcl and EXT_MASK.get(ext, 0) & BIT_TCL):
+                out.append(value)
+            elif (sim_vhdl):
+                out.append("-F " + value)
+        elif (kind == 'qi'):
             # Quartus include
-            if (not opts.sim and not file_type_filter):
-                print('source "{0}{1}"'.format(rel_prefix, value))
+            if (quartus):
+                out.append('source "{0}{1}"'.format(rel_prefix, value))
         else:
-            validateTag(c)
-            tag = lookupTag(c, quartus_tag_map)
-
-            if (opts.sim_vlog):
-                if (lookupTag(c, sim_vlog_tag_map)):
-                    print(c)
-            elif (opts.sim_vhdl):
-                if (lookupTag(c, sim_vhdl_tag_map)):
-                    print(c)
-            elif (opts.json):
-                if (lookupTag(c, json_tag_map)):
-                    print(c)
-            elif (opts.qsys):
-                if (lookupTag(c, qsys_tag_map)):
-                    print(c)
-            elif (opts.ipx):
-                if (lookupTag(c, qsys_ipx_tag_map)):
-                    print(c)
-            elif (opts.tcl):
-                if (lookupTag(c, tcl_tag_map)):
-                    print(c)
-            elif (tag is not None):
+            if (not quartus):
+                if (EXT_MASK[ext] & mode_bit):
+                    out.append(value)
+            else:
+                tag = EXT_INFO[ext][TAG_QUARTUS]
                 # We assume that all bare .tcl files are part of Qsys
                 # and ignore them in Quartus flows. To get a .tcl
                 # file in Quartus, use QI:<path to>.tcl.
-                if (tag != 'SOURCE_TCL_SCRIPT_FILE'):
-                    print('set_global_assignment -name {0} "{1}{2}"'
-                          .format(tag, rel_prefix, c))
+                if (tag is not None and tag != 'SOURCE_TCL_SCRIPT_FILE'):
+                    out.append('set_global_assignment -name {0} "{1}{2}"'
+                               .format(tag, rel_prefix, value))
+
+    if (out):
+        sys.stdout.write('\n'.join(out))
+        sys.stdout.write('\n')
+
+
+#
+# Paths are normalized relative to the target directory. The same
+# (config_dir, tgt_dir, path) tuples recur across recursive includes,
+# so both the directory probes and the normalization are memoized.
+#
+@functools.lru_cache(maxsize=None)
+def _isDir(path):
+    return os.path.isdir(path)
+
+
+# Names of subdirectories, indexed by configuration file directory. False
+# marks a directory that can't be listed.
+_dir_cache = {}
+
+
+#
+# Is c, relative to config_dir, a directory? Most entries are files, so
+# config_dir is read once with scandir() and the first path component is
+# checked against its subdirectories before any stat of the full path.
+#
+def _isSubdir(config_dir, c):
+    head, _sep, tail = c.partition('/')
+    if (head in ('', '.', '..')):
+        # Absolute paths and paths leaving config_dir
+        return _isDir(os.path.join(config_dir, c))
+
+    subdirs = _dir_cache.get(config_dir)
+    if (subdirs is None):
+        try:
+            with os.scandir(config_dir or '.') as it:
+                subdirs = set(e.name for e in it if e.is_dir())
+        except OSError:
+            # Possibly traversable but not readable (e.g. mode 711), so
+            # probe entries individually.
+            subdirs = False
+        _dir_cache[config_dir] = subdirs
+
+    if (subdirs is False):
+        return _isDir(os.path.join(config_dir, c))
+    if (head not in subdirs):
+        return False
+    return (not tail or _isDir(os.path.join(config_dir, c)))
+
+
+@functools.lru_cache(maxsize=None)
+def _normPath(config_dir, tgt_dir, c, abs_flag):
+    # Transform path first to be relative to the configuration file.
+    # Then transform it to be relative to the target directory.
+    p = os.path.relpath(os.path.join(config_dir, c), tgt_dir)
+    if (abs_flag):
+        p = os.path.abspath(p)
+
+    return p
 
 
 #
 # Detect paths in configuration directives and make them relative to the target
 # directory.
 #
-def fixRelPath(opts, c, config_dir, tgt_dir):
+def fixRelPath(opts, c, config_dir, tgt_dir, same_dir=False):
     if (len(c) == 0):
         return c
-    if ("+define+" == c[:8]):
-        return c
 
-    # Everything else ends in a path, though check for prefixes
-    if ("+incdir+" == c[:8]):
+    # Everything but +define+ ends in a path, though check for prefixes.
+    # Most entries are plain paths, which take a single prefix test.
+    if (c.startswith(DIRECTIVE_PREFIXES)):
+        if (c.startswith("+define+")):
+            return c
         prefix = "+incdir+"
         c = c[8:]
     else:
@@ -216,64 +343,129 @@ def fixRelPath(opts, c, config_dir, tgt_dir):
         split = c.split(':', 1)
         if (len(split) <= 1):
             # Is the entry a directory?  If so, canonicalize it as +incdir+.
-            if (os.path.isdir(os.path.join(config_dir, c))):
+            if (_isSubdir(config_dir, c)):
                 prefix = "+incdir+"
         else:
             prefix = split[0] + ":"
             c = split[1]
 
-    # Transform path first to be relative to the configuration file.
-    # Then transform it to be relative to the target directory.
-    p = os.path.relpath(os.path.join(config_dir, c), tgt_dir)
-    if (opts.abs):
-        p = os.path.abspath(p)
+    # A relative path in a configuration file in the target directory
+    # needs no rebasing, only normalization. same_dir is computed by the
+    # caller once per configuration file.
+    if (same_dir and not opts.abs and not os.path.isabs(c)):
+        return prefix + os.path.normpath(c)
+
+    return prefix + _normPath(config_dir, tgt_dir, c, opts.abs)
+
+
+#
+# Parsed configuration files, indexed by (path, tgt_dir, abs). A file
+# included from several places is parsed only once.
+#
+_parse_cache = {}
+
+# Serializes the automatic environment variable setup, since included
+# configuration files are parsed in parallel.
+_env_lock = threading.Lock()
 
-    return prefix + p
+
+#
+# _parse_cache key of a configuration file. Paths are emitted relative to
+# the configuration file's directory, so the key is the absolute path and
+# not the symlink-resolved path.
+#
+def _parseKey(opts, cfg_file_name, tgt_dir):
+    return (os.path.abspath(cfg_file_name), tgt_dir, opts.abs)
 
 
 #
-# Recursive parse of configuration files.
+# Recursive parse of configuration files. Included files are mostly
+# waiting on file system I/O, so the includes of the top-level file are
+# parsed in a thread pool and spliced back into the list in their original
+# order. Deeper levels are parsed serially on the worker threads, which
+# bounds the number of threads. parents holds the cache keys of the files
+# in the current include chain and is used to detect cycles.
 #
-def parseConfigFile(opts, cfg_file_name, tgt_dir):
+def parseConfigFile(opts, cfg_file_name, tgt_dir, parents=()):
     if (len(cfg_file_name) == 0):
         return []
 
-    cfg = []
+    top_level = (len(parents) == 0)
+    key = _parseKey(opts, cfg_file_name, tgt_dir)
+    if (key in _parse_cache):
+        return list(_parse_cache[key])
+    if (key in parents):
+        errorExit("recursive include of {0}".format(cfg_file_name))
+    parents += (key,)
 
     try:
-        dir = os.path.dirname(cfg_file_name)
-        with open(cfg_file_name) as cfg_file:
-            for c in cfg_file:
-                c = c.strip()
-                # Drop comments
-                c = c.split('#', 1)[0]
-
-                # Replace environment variables
-                if ('OPAE_PLATFORM_FPGA_FAMILY' in c and
-                        'OPAE_PLATFORM_FPGA_FAMILY' not in os.environ):
-                    # The source requires version-specific Qsys and the
-                    # tag has not yet been determined.
+        text = Path(cfg_file_name).read_text()
+    except OSError:
+        errorExit("failed to open file ({0})".format(cfg_file_name))
+
+    cfg = []
+    dir = os.path.dirname(cfg_file_name)
+    same_dir = (os.path.abspath(dir) == os.path.abspath(tgt_dir))
+
+    # Recursive includes, as (position in cfg, file name)
+    includes = []
+
+    # Automatically defined environment variables still to be set
+    need_family = 'OPAE_PLATFORM_FPGA_FAMILY' not in os.environ
+    need_qv = ('QUARTUS_VERSION' not in os.environ or
+               'QUARTUS_VERSION_MAJOR' not in os.environ)
+
+    for c in text.splitlines():
+        c = c.strip()
+        # Drop comments
+        c = c.split('#', 1)[0]
+
+        # Replace environment variables. Most lines have none.
+        if ('$' in c):
+            if (need_family and 'OPAE_PLATFORM_FPGA_FAMILY' in c):
+                # The source requires version-specific Qsys and the
+                # tag has not yet been determined.
+                with _env_lock:
                     addDefaultFpgaFamily(opts)
+                need_family = False
 
-                if ('QUARTUS_VERSION' in c and
-                        ('QUARTUS_VERSION' not in os.environ or
-                         'QUARTUS_VERSION_MAJOR' not in os.environ)):
+            if (need_qv and 'QUARTUS_VERSION' in c):
+                with _env_lock:
                     getQuartusVersion(opts)
+                need_qv = False
+
+            c = os.path.expandvars(c)
+
+        # Recursive include?
+        if (c.startswith("C:")):
+            includes.append((len(cfg), os.path.join(dir, c[2:])))
+        elif (len(c)):
+            # Append to the configuration list
+            cfg.append(fixRelPath(opts, c, dir, tgt_dir, same_dir))
+
+    if (top_level and len(includes) > 1):
+        # Submit each distinct file once. Identical sibling includes would
+        # otherwise all miss _parse_cache and be parsed concurrently.
+        names = {}
+        for _pos, name in includes:
+            names.setdefault(_parseKey(opts, name, tgt_dir), name)
+
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            futures = dict(
+                (k, ex.submit(parseConfigFile, opts, name, tgt_dir, parents))
+                for k, name in names.items())
+            results = [futures[_parseKey(opts, name, tgt_dir)].result()
+                       for _pos, name in includes]
+    else:
+        results = [parseConfigFile(opts, inc[1], tgt_dir, parents)
+                   for inc in includes]
 
-                c = os.path.expandvars(c)
-
-                # Recursive include?
-                if (c[:2] == 'C:'):
-                    cfg += parseConfigFile(
-                        opts, os.path.join(dir, c[2:]), tgt_dir)
-                elif (len(c)):
-                    # Append to the configuration list
-                    cfg.append(fixRelPath(opts, c, dir, tgt_dir))
-
-    except IOError:
-        errorExit("failed to open file ({0})".format(cfg_file_name))
+    # Splice from the end so earlier positions remain valid
+    for (pos, _name), sub_cfg in reversed(list(zip(includes, results))):
+        cfg[pos:pos] = sub_cfg
 
-    return cfg
+    _parse_cache[key] = cfg
+    return list(cfg)
 
 
 #
@@ -290,8 +482,13 @@ def parseConfigFile(opts, cfg_file_name, tgt_dir):
 #        hw/lib directory is ${OPAE_PLATFORM_ROOT}/hw/lib.
 #
 def getHWLibPath(opts):
-    if (opts.lib is not None):
-        hw_lib_dir = opts.lib
+    return _resolveHWLibPath(opts.lib)
+
+
+@functools.lru_cache(maxsize=1)
+def _resolveHWLibPath(lib):
+    if (lib is not None):
+        hw_lib_dir = lib
     elif ('BBS_LIB_PATH' in os.environ):
         # Legacy variable, shared with afu_sim_setup and HW releases
         hw_lib_dir = os.environ['BBS_LIB_PATH'].rstrip('/')
@@ -323,22 +520,21 @@ def addDefaultFpgaFamily(opts):
 
     if ('OPAE_PLATFORM_FPGA_FAMILY' not in os.environ):
         try:
-            # Get the FPGA technology tag using afu_platform_info
-            cmd = 'afu_platform_info --key=fpga-family '
-
             # What's the platform name?
             plat_class_file = os.path.join(getHWLibPath(opts),
                                            'fme-platform-class.txt')
             with open(plat_class_file) as f:
-                cmd += f.read().strip()
+                plat_name = f.read().strip()
 
-            proc = subprocess.Popen(cmd, shell=True,
+            # Get the FPGA technology tag using afu_platform_info
+            proc = subprocess.Popen(['afu_platform_info',
+                                     '--key=fpga-family', plat_name],
                                     stdout=subprocess.PIPE)
-            for line in proc.stdout:
-                line = line.decode('ascii').strip()
+            stdout, _ = proc.communicate()
+            for line in stdout.decode('ascii').splitlines():
+                line = line.strip()
                 os.environ['OPAE_PLATFORM_FPGA_FAMILY'] = line
-            errcode = proc.wait()
-            if (errcode):
+            if (proc.returncode):
                 errorExit("failed to set OPAE_PLATFORM_FPGA_FAMILY")
 
             if (not opts.quiet):
@@ -350,6 +546,11 @@ def addDefaultFpgaFamily(opts):
                 str(e)))
 
 
+# Extract major and major.minor version numbers from "quartus_sh --version"
+_QV_MAJ = re.compile(r'\D*(\d*)\..*')
+_QV_MAJMIN = re.compile(r'\D*(\d*\.\d*)\..*')
+
+
 #
 # Invoke Quartus to load its major version number.
 #
@@ -358,23 +559,23 @@ def getQuartusVersion(opts):
             'QUARTUS_VERSION_MAJOR' not in os.environ):
         try:
             # Get the Quartus major version number
-            proc = subprocess.Popen('quartus_sh --version', shell=True,
+            proc = subprocess.Popen(['quartus_sh', '--version'],
                                     stdout=subprocess.PIPE)
+            stdout, _ = proc.communicate()
             ok = False
-            for line in proc.stdout:
-                line = line.decode('ascii').strip()
-                if (line[:7] == 'Version'):
+            for line in stdout.decode('ascii').splitlines():
+                line = line.strip()
+                if (line.startswith('Version')):
                     ok = True
 
                     # Just the major version number
-                    maj = re.sub(r'\D*(\d*)\..*', r'\1', line)
+                    maj = _QV_MAJ.sub(r'\1', line)
                     os.environ['QUARTUS_VERSION_MAJOR'] = maj
                     # Major.minor version
-                    maj_min = re.sub(r'\D*(\d*\.\d*)\..*', r'\1', line)
+                    maj_min = _QV_MAJMIN.sub(r'\1', line)
                     os.environ['QUARTUS_VERSION'] = maj_min
 
-            errcode = proc.wait()
-            if (errcode or not ok):
+            if (proc.returncode or not ok):
                 errorExit("Failed to compute QUARTUS_VERSION")
 
             if (not opts.quiet):
@@ -499,6 +700,9 @@ These commands affect script parsing:
     if opts.sim_vhdl:
         opts.sim = True
 
+    # Output mode, one of MODE_BITS. Quartus (--qsf) is the default.
+    opts.mode = next((m for m in MODE_BITS if getattr(opts, m)), 'qsf')
+
     cfg = parseConfigFile(opts, opts.config_file, opts.rel)
 
     emitCfg(opts, cfg)